@@ -1,26 +1,35 @@
+import concurrent.futures
 import hashlib
 import io
 import lzma
+import mmap
+import os
 import re
-import shutil
 import zipfile
 
 import avbtool
 
-from . import openssl
 from . import util
-from . import vbmeta
 from .formats import bootimage
 from .formats import compression
 from .formats import cpio
 
 
-def _load_ramdisk(ramdisk):
+def _decompress_ramdisk(ramdisk):
     with (
         io.BytesIO(ramdisk) as f_raw,
         compression.CompressedFile(f_raw, 'rb') as f,
     ):
-        return cpio.load(f.fp), f.format
+        # The cpio entries are views into this buffer, so make sure it's
+        # immutable. Some decompressors return a bytearray.
+        return bytes(f.fp.read()), f.format
+
+
+def _load_ramdisk(ramdisk):
+    # The entries reference the decompressed data instead of holding copies
+    data, format = _decompress_ramdisk(ramdisk)
+
+    return cpio.load_buffer(data), format
 
 
 def _save_ramdisk(entries, format):
@@ -31,17 +40,38 @@ def _save_ramdisk(entries, format):
         return f_raw.getvalue()
 
 
+def _content_changed(old_entry, new_entry):
+    # Entries that were carried over from the original ramdisk are the same
+    # objects in both lists
+    if old_entry is new_entry:
+        return False
+    elif len(old_entry.content) != len(new_entry.content):
+        return True
+
+    return old_entry.content != new_entry.content
+
+
 class BootImagePatch:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
     def __call__(self, image_file):
         with open(image_file, 'r+b') as f:
             boot_image = bootimage.load_autodetect(f)
 
             boot_image = self.patch(image_file, boot_image)
 
+            # generate() writes sequentially, so overwrite the image in place
+            # and only drop whatever is left past the end of the new image
             f.seek(0)
-            f.truncate(0)
-
             boot_image.generate(f)
+            f.truncate()
 
     def patch(self, image_file, boot_image):
         raise NotImplementedError()
@@ -67,10 +97,28 @@ class MagiskRootPatch(BootImagePatch):
     )
     VER_PREINIT_DEVICE = util.Range(25211, VERS_SUPPORTED[-1].end)
     VER_RANDOM_SEED = util.Range(25211, VERS_SUPPORTED[-1].end)
+    # Flattened VERS_SUPPORTED for constant time lookups
+    _SUPPORTED_VERSIONS = frozenset(v for r in VERS_SUPPORTED
+                                    for v in range(r.start, r.end))
+
+    # The magisk32/magisk64/stub binaries are compressed the same way
+    # magiskboot does it. Lowering the preset would make compression faster
+    # with a negligible size difference, but would change the output and break
+    # the byte-for-byte reproducibility of patched images.
+    XZ_PRESET = 9
+
+    VERSION_REGEX = re.compile(rb'^MAGISK_VER_CODE=(\d+)', re.MULTILINE)
 
     def __init__(self, magisk_apk, preinit_device, random_seed):
         self.magisk_apk = magisk_apk
-        self.version = self._get_version()
+        self._zip = zipfile.ZipFile(magisk_apk, 'r')
+
+        try:
+            self._names = set(self._zip.namelist())
+            self.version = self._get_version()
+        except BaseException:
+            self._zip.close()
+            raise
 
         self.preinit_device = preinit_device
 
@@ -82,17 +130,16 @@ class MagiskRootPatch(BootImagePatch):
             self.random_seed = random_seed
 
     def _get_version(self):
-        with zipfile.ZipFile(self.magisk_apk, 'r') as z:
-            with z.open('assets/util_functions.sh', 'r') as f:
-                for line in f:
-                    if line.startswith(b'MAGISK_VER_CODE='):
-                        return int(line[16:].strip())
+        data = self._zip.read('assets/util_functions.sh')
+        m = self.VERSION_REGEX.search(data)
+        if m:
+            return int(m.group(1))
 
         raise Exception('Failed to determine Magisk version from: '
                         f'{self.magisk_apk}')
 
     def validate(self):
-        if not any(self.version in s for s in self.VERS_SUPPORTED):
+        if self.version not in self._SUPPORTED_VERSIONS:
             supported = '; '.join(str(s) for s in self.VERS_SUPPORTED)
             raise ValueError(f'Unsupported Magisk version {self.version} '
                              f'(supported: {supported})')
@@ -103,9 +150,11 @@ class MagiskRootPatch(BootImagePatch):
                              f'({self.VER_PREINIT_DEVICE}) requires a preinit '
                              f'device to be specified')
 
+    def close(self):
+        self._zip.close()
+
     def patch(self, image_file, boot_image):
-        with zipfile.ZipFile(self.magisk_apk, 'r') as zip:
-            return self._patch(image_file, boot_image, zip)
+        return self._patch(image_file, boot_image, self._zip)
 
     def _patch(self, image_file, boot_image, zip):
         if len(boot_image.ramdisks) > 1:
@@ -113,16 +162,25 @@ class MagiskRootPatch(BootImagePatch):
                             f'{len(boot_image.ramdisks)} ramdisks')
 
         # Magisk saves the original SHA1 digest in its config file
-        with open(image_file, 'rb') as f:
-            hasher = util.hash_file(f, hashlib.sha1())
+        with (
+            open(image_file, 'rb') as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m,
+        ):
+            hasher = hashlib.sha1(m)
 
         # Load the existing ramdisk if it exists. If it doesn't, we have to
         # generate one from scratch
         if boot_image.ramdisks:
             entries, ramdisk_format = _load_ramdisk(boot_image.ramdisks[0])
         else:
+            # Freshly built ramdisks still use LZ4 HC level 12 like magiskboot.
+            # LZ4's fast mode would compress them quicker, but would change the
+            # output for boot images that start out without a ramdisk and break
+            # the byte-for-byte reproducibility of patched images.
             entries, ramdisk_format = [], compression.Format.LZ4_LEGACY
 
+        # Keyed by name to allow in-place replacement and deletion
+        entries = {e.name: e for e in entries}
         old_entries = entries.copy()
 
         # Create magisk directory structure
@@ -130,16 +188,15 @@ class MagiskRootPatch(BootImagePatch):
             (b'overlay.d', 0o750),
             (b'overlay.d/sbin', 0o750),
         ):
-            entries.append(cpio.CpioEntryNew.new_directory(path, perms=perms))
+            entries[path] = cpio.CpioEntryNew.new_directory(path, perms=perms)
 
         # Delete the original init
-        if boot_image.ramdisks:
-            entries = [e for e in entries if e.name != b'init']
+        entries.pop(b'init', None)
 
         # Add magiskinit
-        with zip.open('lib/arm64-v8a/libmagiskinit.so', 'r') as f:
-            entries.append(cpio.CpioEntryNew.new_file(
-                b'init', perms=0o750, data=f.read()))
+        entries[b'init'] = cpio.CpioEntryNew.new_file(
+            b'init', perms=0o750,
+            data=zip.read('lib/arm64-v8a/libmagiskinit.so'))
 
         # Add xz-compressed magisk32 and magisk64
         xz_files = {
@@ -149,21 +206,27 @@ class MagiskRootPatch(BootImagePatch):
 
         # Add stub apk, which only exists after the Magisk commit:
         # ad0e6511e11ebec65aa9b5b916e1397342850319
-        if 'assets/stub.apk' in zip.namelist():
+        if 'assets/stub.apk' in self._names:
             xz_files['assets/stub.apk'] = b'stub.xz'
 
-        for source, target in xz_files.items():
-            with (
-                zip.open(source, 'r') as f_in,
-                io.BytesIO() as f_out_raw,
-            ):
-                with lzma.open(f_out_raw, 'wb', preset=9,
-                               check=lzma.CHECK_CRC32) as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+        def compress(item):
+            target, data = item
 
-                entries.append(cpio.CpioEntryNew.new_file(
-                    b'overlay.d/sbin/' + target, perms=0o644,
-                    data=f_out_raw.getvalue()))
+            return target, lzma.compress(data, format=lzma.FORMAT_XZ,
+                                         check=lzma.CHECK_CRC32,
+                                         preset=self.XZ_PRESET)
+
+        # The xz compression is CPU bound and lzma releases the GIL, so the
+        # files can be compressed in parallel
+        inputs = [(target, zip.read(source))
+                  for source, target in xz_files.items()]
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(inputs)) as executor:
+            for target, data_out in executor.map(compress, inputs):
+                name = b'overlay.d/sbin/' + target
+                entries[name] = cpio.CpioEntryNew.new_file(
+                    name, perms=0o644, data=data_out)
 
         # Create magisk .backup directory structure
         self._apply_magisk_backup(old_entries, entries)
@@ -184,11 +247,11 @@ class MagiskRootPatch(BootImagePatch):
         if self.version in self.VER_RANDOM_SEED:
             magisk_config += b'RANDOMSEED=0x%x\n' % self.random_seed
 
-        entries.append(cpio.CpioEntryNew.new_file(
-            b'.backup/.magisk', perms=0o000, data=magisk_config))
+        entries[b'.backup/.magisk'] = cpio.CpioEntryNew.new_file(
+            b'.backup/.magisk', perms=0o000, data=magisk_config)
 
         # Repack ramdisk
-        new_ramdisk = _save_ramdisk(entries, ramdisk_format)
+        new_ramdisk = _save_ramdisk(list(entries.values()), ramdisk_format)
         if boot_image.ramdisks:
             boot_image.ramdisks[0] = new_ramdisk
         else:
@@ -199,34 +262,32 @@ class MagiskRootPatch(BootImagePatch):
     @staticmethod
     def _apply_magisk_backup(old_entries, new_entries):
         '''
-        Compare old and new ramdisk entry lists, creating the Magisk `.backup/`
-        directory structure. `.backup/.rmlist` will contain a sorted list of
+        Compare old and new ramdisk entries, creating the Magisk `.backup/`
+        directory structure. Both arguments are dicts mapping entry names to
+        entries. `.backup/.rmlist` will contain a sorted list of
         NULL-terminated strings, listing which files were newly added or
         changed. The old entries for changed files will be added to the new
         entries as `.backup/<path>`.
 
-        Both lists and entries within the lists may be mutated.
+        Both dicts and entries within the dicts may be mutated.
         '''
 
-        old_by_name = {e.name: e for e in old_entries}
-        new_by_name = {e.name: e for e in new_entries}
+        added = new_entries.keys() - old_entries.keys()
+        deleted = old_entries.keys() - new_entries.keys()
+        changed = set(n for n in old_entries.keys() & new_entries.keys()
+                      if _content_changed(old_entries[n], new_entries[n]))
 
-        added = new_by_name.keys() - old_by_name.keys()
-        deleted = old_by_name.keys() - new_by_name.keys()
-        changed = set(n for n in old_by_name.keys() & new_by_name.keys()
-                      if old_by_name[n].content != new_by_name[n].content)
-
-        new_entries.append(cpio.CpioEntryNew.new_directory(
-            b'.backup', perms=0o000))
+        new_entries[b'.backup'] = cpio.CpioEntryNew.new_directory(
+            b'.backup', perms=0o000)
 
         for name in deleted | changed:
-            entry = old_by_name[name]
+            entry = old_entries[name]
             entry.name = b'.backup/' + entry.name
-            new_entries.append(entry)
+            new_entries[entry.name] = entry
 
         rmlist_data = b''.join(n + b'\0' for n in sorted(added))
-        new_entries.append(cpio.CpioEntryNew.new_file(
-            b'.backup/.rmlist', perms=0o000, data=rmlist_data))
+        new_entries[b'.backup/.rmlist'] = cpio.CpioEntryNew.new_file(
+            b'.backup/.rmlist', perms=0o000, data=rmlist_data)
 
 
 class OtaCertPatch(BootImagePatch):
@@ -239,44 +300,74 @@ class OtaCertPatch(BootImagePatch):
 
     def __init__(self, cert_ota):
         self.cert_ota = cert_ota
+        self._otacerts_zip = self._generate_otacerts_zip(cert_ota)
+
+    @staticmethod
+    def _generate_otacerts_zip(cert_ota):
+        '''
+        Create new otacerts archive containing only the specified certificate.
+        '''
+
+        with io.BytesIO() as f_zip:
+            with zipfile.ZipFile(f_zip, 'w') as z:
+                # Use zeroed-out metadata to ensure the archive is bit for bit
+                # reproducible across runs.
+                info = zipfile.ZipInfo('ota.x509.pem')
+                # Mark entry as created on Unix for reproducibility
+                info.create_system = 3
+                with (
+                    z.open(info, 'w') as f_out,
+                    open(cert_ota, 'rb') as f_in,
+                ):
+                    # The certificate is tiny
+                    f_out.write(f_in.read())
+
+            return f_zip.getvalue()
+
+    def _patch_ramdisk(self, ramdisk):
+        '''
+        Replace otacerts in the specified ramdisk. Returns the new ramdisk or
+        None if the ramdisk does not contain otacerts.
+        '''
+
+        data, ramdisk_format = _decompress_ramdisk(ramdisk)
+
+        # cpio stores paths verbatim, so skip parsing ramdisks that can't
+        # possibly contain otacerts
+        if self.OTACERTS_PATH not in data:
+            return None
+
+        entries = cpio.load_buffer(data)
+
+        otacerts = next((e for e in entries if e.name ==
+                         self.OTACERTS_PATH), None)
+        if not otacerts:
+            return None
+
+        # Replace with the new otacerts archive. The old certs are ignored
+        # since flashing a stock OTA will render the device unbootable.
+        otacerts.content = self._otacerts_zip
+
+        # Repack ramdisk
+        return _save_ramdisk(entries, ramdisk_format)
 
     def patch(self, image_file, boot_image):
-        found_otacerts = False
+        # The ramdisks are independent and (de)compression releases the GIL, so
+        # they can be processed in parallel
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(len(boot_image.ramdisks), 1)) as executor:
+            new_ramdisks = list(executor.map(self._patch_ramdisk,
+                                             boot_image.ramdisks))
 
-        # Check each ramdisk
-        for i, ramdisk in enumerate(boot_image.ramdisks):
-            entries, ramdisk_format = _load_ramdisk(ramdisk)
+        found_otacerts = False
 
-            # Fail hard if otacerts does not exist. We don't want to lock the
-            # user out of future updates if the OTA certificate mechanism has
-            # changed.
-            otacerts = next((e for e in entries if e.name ==
-                             self.OTACERTS_PATH), None)
-            if otacerts:
+        for i, new_ramdisk in enumerate(new_ramdisks):
+            if new_ramdisk is not None:
+                boot_image.ramdisks[i] = new_ramdisk
                 found_otacerts = True
-            else:
-                continue
-
-            # Create new otacerts archive. The old certs are ignored since
-            # flashing a stock OTA will render the device unbootable.
-            with io.BytesIO() as f_zip:
-                with zipfile.ZipFile(f_zip, 'w') as z:
-                    # Use zeroed-out metadata to ensure the archive is bit for
-                    # bit reproducible across runs.
-                    info = zipfile.ZipInfo('ota.x509.pem')
-                    # Mark entry as created on Unix for reproducibility
-                    info.create_system = 3
-                    with (
-                        z.open(info, 'w') as f_out,
-                        open(self.cert_ota, 'rb') as f_in,
-                    ):
-                        shutil.copyfileobj(f_in, f_out)
-
-                otacerts.content = f_zip.getvalue()
-
-            # Repack ramdisk
-            boot_image.ramdisks[i] = _save_ramdisk(entries, ramdisk_format)
 
+        # Fail hard if otacerts does not exist. We don't want to lock the user
+        # out of future updates if the OTA certificate mechanism has changed.
         if not found_otacerts:
             raise Exception(f'{self.OTACERTS_PATH} not found in ramdisk')
 
@@ -297,7 +388,10 @@ class PrepatchedImage(BootImagePatch):
     MAX_LEVEL = 2
 
     VERSION_REGEX = re.compile(
-        b'Linux version (\d+\.\d+).\d+-(android\d+)-(\d+)-')
+        rb'Linux version (\d+\.\d+)\.\d+-(android\d+)-(\d+)-')
+    # Upper bound for the length of a VERSION_REGEX match. This much data is
+    # kept from the previous chunk when searching a stream.
+    VERSION_MAX_SIZE = 256
 
     def __init__(self, prepatched, fatal_level, warning_fn):
         self.prepatched = prepatched
@@ -305,7 +399,7 @@ class PrepatchedImage(BootImagePatch):
         self.warning_fn = warning_fn
 
     def patch(self, image_file, boot_image):
-        with open(self.prepatched, 'r+b') as f:
+        with open(self.prepatched, 'rb') as f:
             prepatched_image = bootimage.load_autodetect(f)
 
         old_header = boot_image.to_dict()
@@ -316,14 +410,20 @@ class PrepatchedImage(BootImagePatch):
         # Level 2: Warnings that are very likely to affect booting
         issues = [[], [], []]
 
-        for k in new_header.keys() - old_header.keys():
+        old_keys = old_header.keys()
+        new_keys = new_header.keys()
+
+        for k in new_keys - old_keys:
             issues[2].append(f'{k} header field was added')
 
-        for k in old_header.keys() - new_header.keys():
+        for k in old_keys - new_keys:
             issues[2].append(f'{k} header field was removed')
 
-        for k in old_header.keys() & new_header.keys():
-            if old_header[k] != new_header[k]:
+        for k in old_keys & new_keys:
+            old_value = old_header[k]
+            new_value = new_header[k]
+
+            if old_value != new_value:
                 if k in ('id', 'os_version'):
                     level = 0
                 elif k in ('cmdline', 'extra_cmdline'):
@@ -332,7 +432,7 @@ class PrepatchedImage(BootImagePatch):
                     level = 2
 
                 issues[level].append(f'{k} header field was changed: '
-                                     f'{old_header[k]} -> {new_header[k]}')
+                                     f'{old_value} -> {new_value}')
 
         for attr in 'kernel', 'second', 'recovery_dtbo', 'dtb', 'bootconfig':
             original_val = getattr(boot_image, attr)
@@ -375,6 +475,27 @@ class PrepatchedImage(BootImagePatch):
 
         return prepatched_image
 
+    @classmethod
+    def _search_version(cls, f, buf_size=65536):
+        '''
+        Search for VERSION_REGEX in <f> without reading more data than needed.
+        The linux banner is in the kernel's rodata section, so it can be
+        anywhere in the image.
+        '''
+
+        tail = b''
+
+        while data := f.read(buf_size):
+            data = tail + data
+
+            m = cls.VERSION_REGEX.search(data)
+            if m:
+                return m
+
+            tail = data[-cls.VERSION_MAX_SIZE:]
+
+        return None
+
     @classmethod
     def _get_kmi_version(cls, boot_image):
         try:
@@ -382,22 +503,24 @@ class PrepatchedImage(BootImagePatch):
                 io.BytesIO(boot_image.kernel) as f_raw,
                 compression.CompressedFile(f_raw, 'rb') as f,
             ):
-                decompressed = f.fp.read()
+                m = cls._search_version(f.fp)
         except ValueError:
-            decompressed = boot_image.kernel
+            m = cls.VERSION_REGEX.search(boot_image.kernel)
 
-        m = cls.VERSION_REGEX.search(decompressed)
         if not m:
             return None
 
         return b'-'.join(m.groups()).decode('ascii')
 
 
-def patch_boot(avb, input_path, output_path, key, passphrase,
-               only_if_previously_signed, patch_funcs):
+def patch_boot(avb, input_path, output_path, key, only_if_previously_signed,
+               patch_funcs):
     '''
     Call each function in patch_funcs against a boot image with vbmeta stripped
     out and then resign the image using the provided private key.
+
+    This must be called within vbmeta.smuggle_descriptors() and
+    openssl.inject_passphrase() for the passphrase of <key>.
     '''
 
     image = avbtool.ImageHandler(input_path, read_only=True)
@@ -435,7 +558,11 @@ def patch_boot(avb, input_path, output_path, key, passphrase,
         algorithm_name = 'SHA256_RSA4096'
 
     with util.open_output_file(output_path) as f:
-        shutil.copyfile(input_path, f.name)
+        with open(input_path, 'rb') as f_in:
+            util.copy_file_range_n(f_in, f, os.fstat(f_in.fileno()).st_size)
+
+        # avbtool opens the file by path
+        f.flush()
 
         # Strip the vbmeta footer from the boot image
         avb.erase_footer(f.name, False)
@@ -445,37 +572,33 @@ def patch_boot(avb, input_path, output_path, key, passphrase,
             patch_func(f.name)
 
         # Sign the new boot image
-        with (
-            vbmeta.smuggle_descriptors(),
-            openssl.inject_passphrase(passphrase),
-        ):
-            avb.add_hash_footer(
-                image_filename=f.name,
-                partition_size=image_size,
-                dynamic_partition_size=False,
-                partition_name=hash.partition_name,
-                hash_algorithm=hash.hash_algorithm,
-                salt=hash.salt.hex(),
-                chain_partitions=None,
-                algorithm_name=algorithm_name,
-                key_path=key,
-                public_key_metadata_path=None,
-                rollback_index=header.rollback_index,
-                flags=header.flags,
-                rollback_index_location=header.rollback_index_location,
-                props=None,
-                props_from_file=None,
-                kernel_cmdlines=new_descriptors,
-                setup_rootfs_from_kernel=None,
-                include_descriptors_from_image=None,
-                calc_max_image_size=False,
-                signing_helper=None,
-                signing_helper_with_files=None,
-                release_string=header.release_string,
-                append_to_release_string=None,
-                output_vbmeta_image=None,
-                do_not_append_vbmeta_image=False,
-                print_required_libavb_version=False,
-                use_persistent_digest=False,
-                do_not_use_ab=False,
-            )
+        avb.add_hash_footer(
+            image_filename=f.name,
+            partition_size=image_size,
+            dynamic_partition_size=False,
+            partition_name=hash.partition_name,
+            hash_algorithm=hash.hash_algorithm,
+            salt=hash.salt.hex(),
+            chain_partitions=None,
+            algorithm_name=algorithm_name,
+            key_path=key,
+            public_key_metadata_path=None,
+            rollback_index=header.rollback_index,
+            flags=header.flags,
+            rollback_index_location=header.rollback_index_location,
+            props=None,
+            props_from_file=None,
+            kernel_cmdlines=new_descriptors,
+            setup_rootfs_from_kernel=None,
+            include_descriptors_from_image=None,
+            calc_max_image_size=False,
+            signing_helper=None,
+            signing_helper_with_files=None,
+            release_string=header.release_string,
+            append_to_release_string=None,
+            output_vbmeta_image=None,
+            do_not_append_vbmeta_image=False,
+            print_required_libavb_version=False,
+            use_persistent_digest=False,
+            do_not_use_ab=False,
+        )
@@ -2,6 +2,7 @@
 # DualBootPatcher, supporting only enough of the file format for messing with
 # boot image ramdisks. Only the "new format" for cpio entries are supported.
 
+import os
 import stat
 import typing
 
@@ -32,6 +33,62 @@ def _write_int(f: typing.BinaryIO, value: int) -> int:
     return f.write(b'%08x' % value)
 
 
+class _BufferReader:
+    '''
+    Minimal read-only file-like object over a bytes-like object. Entry
+    contents are read with read_content() as memoryview slices of the buffer
+    to avoid copies.
+    '''
+
+    def __init__(self, data) -> None:
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def read(self, size: typing.Optional[int] = None) -> memoryview:
+        if size is None or size < 0:
+            end = len(self.view)
+        else:
+            end = min(self.offset + size, len(self.view))
+
+        data = self.view[self.offset:end]
+        self.offset = max(self.offset, end)
+
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self.offset = offset
+        elif whence == os.SEEK_CUR:
+            self.offset += offset
+        elif whence == os.SEEK_END:
+            self.offset = len(self.view) + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+
+        return self.offset
+
+    def tell(self) -> int:
+        return self.offset
+
+    def read_content(self, size: int) -> memoryview:
+        data = self.read(size)
+        if len(data) != size:
+            raise EOFError(f'Unexpected EOF: expected {size} bytes, '
+                           f'but only read {len(data)} bytes')
+
+        return data
+
+
+def _read_content(f: typing.BinaryIO,
+                  size: int) -> typing.Union[bytes, memoryview]:
+    # Readers over an in-memory buffer can return a view instead of a copy
+    read_content = getattr(f, 'read_content', None)
+    if read_content is not None:
+        return read_content(size)
+
+    return util.read_exact(f, size)
+
+
 class CpioEntryNew:
     # c_magic     - "070701" for "new" portable format
     #               "070702" for CRC format
@@ -146,7 +203,7 @@ class CpioEntryNew:
             padding.read_skip(f, 4)
 
             # File contents
-            self._content = util.read_exact(f, self.filesize)
+            self._content = _read_content(f, self.filesize)
             padding.read_skip(f, 4)
 
     def write(self, f: typing.BinaryIO):
@@ -188,11 +245,16 @@ class CpioEntryNew:
         self.namesize = len(value) + 1
 
     @property
-    def content(self) -> bytes:
+    def content(self) -> typing.Union[bytes, memoryview]:
+        '''
+        The file contents. This is a bytes-like object, not necessarily bytes.
+        For entries from load_buffer(), it is a memoryview of the buffer.
+        '''
+
         return self._content
 
     @content.setter
-    def content(self, value: bytes):
+    def content(self, value: typing.Union[bytes, memoryview]):
         self._content = value
         self.filesize = len(value)
 
@@ -260,6 +322,16 @@ def load(f: typing.BinaryIO, include_trailer: bool = False,
     return entries
 
 
+def load_buffer(data, **kwargs) -> list[CpioEntryNew]:
+    '''
+    Same as load(), but parse from a bytes-like object. The entries' contents
+    are memoryview slices that reference <data> instead of copies. Pass an
+    immutable object, like bytes, if the contents must not change.
+    '''
+
+    return load(_BufferReader(data), **kwargs)
+
+
 def save(f: typing.BinaryIO, entries: list[CpioEntryNew], sort=True,
          pad_to_block_size=False):
     inode = 300000
@@ -1,13 +1,15 @@
 import argparse
+import collections
 import concurrent.futures
 import contextlib
-import copy
 import dataclasses
 import graphlib
 import io
+import logging
 import os
 import shutil
 import struct
+import sys
 import tempfile
 import time
 import typing
@@ -41,6 +43,11 @@ PARTITION_PRIORITIES = {
     '@otacerts': ('recovery', 'vendor_boot', 'boot'),
 }
 
+# Zip extra field record header: signature, data length
+_EXTRA_HDR = struct.Struct('<HH')
+# Zip local file header
+_LFH = struct.Struct(zipfile.structFileHeader)
+
 
 @dataclasses.dataclass
 class PatchContext:
@@ -53,18 +60,56 @@ class PatchContext:
     privkey_ota: os.PathLike[str]
     passphrase_ota: str
     cert_ota: os.PathLike[str]
+    executor: concurrent.futures.Executor
+
+
+_logger = logging.getLogger('avbroot')
+
+
+class _StatusFormatter(logging.Formatter):
+    '''
+    Formatter that highlights status messages and warnings.
+    '''
+
+    def format(self, record):
+        message = super().format(record)
+
+        if record.levelno >= logging.WARNING:
+            return f'\x1b[1;31m***** [WARNING] {message} *****\x1b[0m'
+        else:
+            return f'\x1b[1m***** {message} *****\x1b[0m'
+
+
+def _setup_logging():
+    if _logger.handlers:
+        return
 
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(_StatusFormatter())
 
-def print_status(*args, **kwargs):
-    print('\x1b[1m*****', *args, '*****\x1b[0m', **kwargs)
+    _logger.addHandler(handler)
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
 
 
-def print_warning(*args, **kwargs):
-    print('\x1b[1;31m*****', '[WARNING]', *args, '*****\x1b[0m', **kwargs)
+def print_status(*args):
+    # Like print(), the arguments are joined with spaces, but the formatting is
+    # deferred until the message is actually emitted
+    _logger.info(' '.join(['%s'] * len(args)), *args)
 
 
-def get_partitions_by_type(manifest):
-    all_partitions = set(p.partition_name for p in manifest.partitions)
+def print_warning(*args):
+    _logger.warning(' '.join(['%s'] * len(args)), *args)
+
+
+def get_all_partitions(manifest):
+    return set(p.partition_name for p in manifest.partitions)
+
+
+def get_partitions_by_type(manifest, all_partitions=None):
+    if all_partitions is None:
+        all_partitions = get_all_partitions(manifest)
+
     by_type = {}
 
     for t, candidates in PARTITION_PRIORITIES.items():
@@ -81,9 +126,12 @@ def get_partitions_by_type(manifest):
     return by_type
 
 
-def get_required_images(manifest, boot_partition, with_root):
-    all_partitions = set(p.partition_name for p in manifest.partitions)
-    by_type = get_partitions_by_type(manifest)
+def get_required_images(manifest, boot_partition, with_root,
+                        all_partitions=None):
+    if all_partitions is None:
+        all_partitions = get_all_partitions(manifest)
+
+    by_type = get_partitions_by_type(manifest, all_partitions)
     images = {k: v for k, v in by_type.items()
               if k == '@otacerts' or k.startswith('@vbmeta:')}
 
@@ -98,6 +146,27 @@ def get_required_images(manifest, boot_partition, with_root):
     return images
 
 
+def get_required_image_sets(manifest, boot_partition, with_root,
+                            already_have, all_partitions=None):
+    '''
+    Same as get_required_images(), but also return the set of required vbmeta
+    images and the set of required images not in <already_have>.
+    '''
+
+    images = get_required_images(manifest, boot_partition, with_root,
+                                 all_partitions)
+    vbmeta_images = set()
+    to_extract = set()
+
+    for t, partition in images.items():
+        if t.startswith('@vbmeta:'):
+            vbmeta_images.add(partition)
+        if partition not in already_have:
+            to_extract.add(partition)
+
+    return images, vbmeta_images, to_extract
+
+
 def get_vbmeta_patch_order(avb, image_paths, vbmeta_images):
     dep_graph = vbmeta.get_vbmeta_deps(
         avb, {n: image_paths[n] for n in vbmeta_images})
@@ -106,16 +175,34 @@ def get_vbmeta_patch_order(avb, image_paths, vbmeta_images):
     dep_graph = {n: {d for d in deps if d in image_paths}
                  for n, deps in dep_graph.items() if n in image_paths}
 
-    # Avoid patching vbmeta images that don't need changes
-    while True:
-        unneeded_vbmeta = set(n for n, d in dep_graph.items()
-                              if n in vbmeta_images and not d)
-        if not unneeded_vbmeta:
-            break
+    # Avoid patching vbmeta images that don't need changes. A vbmeta image is
+    # unneeded if all of its dependencies are unneeded vbmeta images, so prune
+    # them leaves first while tracking the number of remaining dependencies.
+    dependents = collections.defaultdict(set)
+    remaining = {}
+
+    for n, deps in dep_graph.items():
+        remaining[n] = len(deps)
+
+        for d in deps:
+            dependents[d].add(n)
+
+    unneeded_vbmeta = set()
+    queue = collections.deque(n for n, c in remaining.items()
+                              if c == 0 and n in vbmeta_images)
+
+    while queue:
+        n = queue.popleft()
+        unneeded_vbmeta.add(n)
+
+        for m in dependents[n]:
+            remaining[m] -= 1
+            if remaining[m] == 0 and m in vbmeta_images:
+                queue.append(m)
 
-        dep_graph = {n: {d for d in deps if d not in unneeded_vbmeta}
-                     for n, deps in dep_graph.items()
-                     if n not in unneeded_vbmeta}
+    dep_graph = {n: deps - unneeded_vbmeta
+                 for n, deps in dep_graph.items()
+                 if n not in unneeded_vbmeta}
 
     full_order = graphlib.TopologicalSorter(dep_graph).static_order()
     order = [n for n in full_order if n in vbmeta_images]
@@ -125,6 +212,8 @@ def get_vbmeta_patch_order(avb, image_paths, vbmeta_images):
 
 def patch_ota_payload(f_in, open_more_f_in, f_out, file_size,
                       context: PatchContext):
+    executor = context.executor
+
     with tempfile.TemporaryDirectory() as temp_dir:
         extract_dir = os.path.join(temp_dir, 'extract')
         patch_dir = os.path.join(temp_dir, 'patch')
@@ -134,7 +223,7 @@ def patch_ota_payload(f_in, open_more_f_in, f_out, file_size,
         os.mkdir(payload_dir)
 
         version, manifest, blob_offset = ota.parse_payload(f_in)
-        all_partitions = set(p.partition_name for p in manifest.partitions)
+        all_partitions = get_all_partitions(manifest)
         image_paths = {}
 
         # Use user-provided partition images if provided. This may be a larger
@@ -147,12 +236,14 @@ def patch_ota_payload(f_in, open_more_f_in, f_out, file_size,
             image_paths[name] = path
 
         # Extract remaining required partition images from the original payload.
-        required_images = get_required_images(manifest, context.boot_partition,
-                                              context.root_patch is not None)
-        vbmeta_images = set(p for n, p in required_images.items()
-                            if n.startswith('@vbmeta:'))
+        required_images, vbmeta_images, to_extract = get_required_image_sets(
+            manifest,
+            context.boot_partition,
+            context.root_patch is not None,
+            image_paths.keys(),
+            all_partitions,
+        )
 
-        to_extract = required_images.values() - image_paths.keys()
         for name in to_extract:
             image_paths[name] = os.path.join(extract_dir, f'{name}.img')
 
@@ -160,7 +251,7 @@ def patch_ota_payload(f_in, open_more_f_in, f_out, file_size,
             print_status('Extracting', ', '.join(sorted(to_extract)),
                          'from the payload')
             ota.extract_images(open_more_f_in, manifest, blob_offset,
-                               extract_dir, to_extract)
+                               extract_dir, to_extract, executor=executor)
 
         image_patches = {}
         if context.root_patch is not None:
@@ -171,50 +262,117 @@ def patch_ota_payload(f_in, open_more_f_in, f_out, file_size,
 
         avb = avbtool.Avb()
 
+        # The dependency graph only depends on the original vbmeta images and
+        # the set of images we're working with, so it can be computed before
+        # anything is patched
+        vbmeta_deps, vbmeta_order = \
+            get_vbmeta_patch_order(avb, image_paths, vbmeta_images)
+
         print_status('Patching', ', '.join(sorted(image_patches)))
-        with concurrent.futures.ThreadPoolExecutor(
-                max_workers=len(image_patches)) as executor:
-            def apply_patches(image, patches):
-                patched_path = os.path.join(patch_dir, f'{image}.img')
-
-                boot.patch_boot(
-                    avb,
-                    image_paths[image],
-                    patched_path,
-                    context.privkey_avb,
-                    context.passphrase_avb,
-                    True,
-                    patches,
-                )
+        print_status('Building', ', '.join(vbmeta_order))
 
-                image_paths[image] = patched_path
+        def get_patched_path(image):
+            # Each image gets its own directory so that parallel workers don't
+            # all create files in the same directory
+            image_dir = os.path.join(patch_dir, image)
+            os.mkdir(image_dir)
 
-            futures = [executor.submit(apply_patches, i, p)
-                       for i, p in image_patches.items()]
+            return os.path.join(image_dir, f'{image}.img')
 
-            for future in concurrent.futures.as_completed(futures):
-                future.result()
+        def apply_patches(image, patches):
+            patched_path = get_patched_path(image)
 
-        vbmeta_deps, vbmeta_order = \
-            get_vbmeta_patch_order(avb, image_paths, vbmeta_images)
-        print_status('Building', ', '.join(vbmeta_order))
+            boot.patch_boot(
+                avb,
+                image_paths[image],
+                patched_path,
+                context.privkey_avb,
+                True,
+                patches,
+            )
 
-        for image in vbmeta_order:
-            patched_path = os.path.join(patch_dir, f'{image}.img')
+            return patched_path
+
+        def build_vbmeta(image, deps, input_path):
+            patched_path = get_patched_path(image)
 
             vbmeta.patch_vbmeta_image(
                 avb,
-                {n: p for n, p in image_paths.items()
-                 if n in vbmeta_deps[image]},
-                image_paths[image],
+                deps,
+                input_path,
                 patched_path,
                 context.privkey_avb,
-                context.passphrase_avb,
                 manifest.block_size,
                 context.clear_vbmeta_flags,
             )
 
-            image_paths[image] = patched_path
+            return patched_path
+
+        # A vbmeta image can be built once all of the images it depends on
+        # have been patched or built. Track the number of those that are still
+        # pending so that independent vbmeta images are built in parallel.
+        dependents = collections.defaultdict(list)
+        remaining = {}
+
+        for image in vbmeta_order:
+            pending = [d for d in vbmeta_deps[image]
+                       if d in image_patches or d in remaining]
+            remaining[image] = len(pending)
+
+            for d in pending:
+                dependents[d].append(image)
+
+        # avbtool is monkey patched for the whole stage instead of around each
+        # image because unittest.mock.patch() is not thread safe. All images
+        # are signed with the same AVB key, so the passphrase can be injected
+        # once too.
+        with (
+            vbmeta.smuggle_descriptors(),
+            openssl.inject_passphrase(context.passphrase_avb),
+        ):
+            # Future -> image name
+            futures = {}
+
+            def submit_vbmeta(image):
+                deps = {n: p for n, p in image_paths.items()
+                        if n in vbmeta_deps[image]}
+                future = executor.submit(build_vbmeta, image, deps,
+                                         image_paths[image])
+                futures[future] = image
+
+            for image, patches in image_patches.items():
+                futures[executor.submit(apply_patches, image, patches)] = image
+
+            for image, count in remaining.items():
+                if count == 0:
+                    submit_vbmeta(image)
+
+            try:
+                # image_paths is only updated from this thread
+                done = set()
+
+                while len(done) < len(futures):
+                    newly_done, _ = concurrent.futures.wait(
+                        futures.keys() - done,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+
+                    for future in newly_done:
+                        image = futures[future]
+                        image_paths[image] = future.result()
+                        done.add(future)
+
+                        for m in dependents[image]:
+                            remaining[m] -= 1
+                            if remaining[m] == 0:
+                                submit_vbmeta(m)
+            except BaseException:
+                # The executor outlives the temp directory and these patches,
+                # so make sure nothing is still using them
+                for future in futures:
+                    future.cancel()
+                concurrent.futures.wait(futures)
+                raise
 
         # Don't replace untouched vbmeta images
         for image in vbmeta_images - set(vbmeta_order):
@@ -237,23 +395,53 @@ def patch_ota_payload(f_in, open_more_f_in, f_out, file_size,
 
 
 def strip_bad_extra_fields(extra):
+    view = memoryview(extra)
     offset = 0
-    new_extra = bytearray()
+    kept = []
 
-    while offset < len(extra):
-        record_sig, record_len = \
-            struct.unpack('<HH', extra[offset:offset + 4])
+    while offset < len(view):
+        record_sig, record_len = _EXTRA_HDR.unpack_from(view, offset)
 
-        next_offset = offset + 4 + record_len
+        next_offset = offset + _EXTRA_HDR.size + record_len
 
         # 0xd935: ALIGNMENT_ZIP_EXTRA_DATA_FIELD_HEADER_ID
         # 0x0001: zip64 size (zipfile will write a new record)
         if record_sig not in (0x0001, 0xd935):
-            new_extra.extend(extra[offset:next_offset])
+            if kept and kept[-1][1] == offset:
+                kept[-1] = (kept[-1][0], next_offset)
+            else:
+                kept.append((offset, next_offset))
 
         offset = next_offset
 
-    return new_extra
+    # Avoid copying if nothing was stripped
+    if kept == [(0, len(view))]:
+        return extra
+
+    return b''.join(view[start:end] for start, end in kept)
+
+
+def _clone_info(info):
+    '''
+    Create a new ZipInfo for writing an entry read from another zip. Only the
+    fields that ZipFile doesn't recompute when writing are copied. file_size is
+    included because it determines whether a zip64 record is written upfront.
+    '''
+
+    out = zipfile.ZipInfo(info.filename, info.date_time)
+    out.compress_type = info.compress_type
+    out.comment = info.comment
+    out.extra = strip_bad_extra_fields(info.extra)
+    out.create_system = info.create_system
+    out.create_version = info.create_version
+    out.extract_version = info.extract_version
+    out.reserved = info.reserved
+    out.volume = info.volume
+    out.internal_attr = info.internal_attr
+    out.external_attr = info.external_attr
+    out.file_size = info.file_size
+
+    return out
 
 
 @contextlib.contextmanager
@@ -269,21 +457,31 @@ def fix_streaming_local_header_sizes():
 
     def wrapper(*args, **kwargs):
         blob = orig(*args, **kwargs)
+        info = args[0]
+
+        # Only entries with data descriptors are affected
+        if not (info.flag_bits & (1 << 3)):
+            return blob
+
+        # The sizes are not cached on the ZipInfo because the same instance
+        # may be serialized more than once with different sizes
         zip64 = kwargs.get('zip64')
         if zip64 is None:
-            zip64 = args[0].file_size > zipfile.ZIP64_LIMIT or \
-                args[0].compress_size > zipfile.ZIP64_LIMIT
+            zip64 = info.file_size > zipfile.ZIP64_LIMIT or \
+                info.compress_size > zipfile.ZIP64_LIMIT
 
-        fields = list(struct.unpack_from(zipfile.structFileHeader, blob))
-        if fields[3] & (1 << 3) and zip64:
-            fields[8] = 0xffffffff
-            fields[9] = 0xffffffff
-
-            return struct.pack(zipfile.structFileHeader, *fields) + \
-                blob[zipfile.sizeFileHeader:]
-        else:
+        if not zip64:
             return blob
 
+        fields = list(_LFH.unpack_from(blob))
+        fields[8] = 0xffffffff
+        fields[9] = 0xffffffff
+
+        buf = bytearray(blob)
+        _LFH.pack_into(buf, 0, *fields)
+
+        return bytes(buf)
+
     with unittest.mock.patch('zipfile.ZipInfo.FileHeader', wrapper):
         yield
 
@@ -291,7 +489,7 @@ def fix_streaming_local_header_sizes():
 def patch_ota_zip(f_zip_in, f_zip_out, context: PatchContext):
     with (
         zipfile.ZipFile(f_zip_in, 'r') as z_in,
-        zipfile.ZipFile(f_zip_out, 'w') as z_out,
+        zipfile.ZipFile(f_zip_out, 'w', allowZip64=True) as z_out,
     ):
         infolist = z_in.infolist()
         missing = {
@@ -300,26 +498,16 @@ def patch_ota_zip(f_zip_in, f_zip_out, context: PatchContext):
             PATH_OTACERT,
             PATH_PAYLOAD,
             PATH_PROPERTIES,
-        }
-        i_payload = -1
-        i_properties = -1
-
-        for i, info in enumerate(infolist):
-            if info.filename in missing:
-                missing.remove(info.filename)
-
-            if info.filename == PATH_PAYLOAD:
-                i_payload = i
-            elif info.filename == PATH_PROPERTIES:
-                i_properties = i
-
-            if not missing and i_payload >= 0 and i_properties >= 0:
-                break
+        } - z_in.NameToInfo.keys()
 
         if missing:
             raise Exception(f'Missing files in zip: {missing}')
 
-        # Ensure payload is processed before properties
+        # Ensure payload is processed before properties. They're swapped so
+        # that every other entry keeps its original position.
+        i_payload = infolist.index(z_in.NameToInfo[PATH_PAYLOAD])
+        i_properties = infolist.index(z_in.NameToInfo[PATH_PROPERTIES])
+
         if i_payload > i_properties:
             infolist[i_payload], infolist[i_properties] = \
                 infolist[i_properties], infolist[i_payload]
@@ -327,11 +515,10 @@ def patch_ota_zip(f_zip_in, f_zip_out, context: PatchContext):
         properties = None
         metadata_info = None
         metadata_pb_info = None
-        metadata_pb_raw = None
+        orig_metadata = None
 
         for info in infolist:
-            out_info = copy.copy(info)
-            out_info.extra = strip_bad_extra_fields(out_info.extra)
+            out_info = _clone_info(info)
 
             # Ignore because the plain-text legacy metadata file is regenerated
             # from the new metadata
@@ -343,8 +530,10 @@ def patch_ota_zip(f_zip_in, f_zip_out, context: PatchContext):
             elif info.filename == PATH_METADATA_PB:
                 metadata_pb_info = out_info
 
+                # Parse immediately so that the raw data isn't kept around
+                # and invalid metadata is reported before patching the payload
                 with z_in.open(info, 'r') as f_in:
-                    metadata_pb_raw = f_in.read()
+                    orig_metadata = ota.parse_metadata(f_in.read())
 
                 continue
 
@@ -392,14 +581,17 @@ def patch_ota_zip(f_zip_in, f_zip_out, context: PatchContext):
                 else:
                     print_status('Copying', info.filename)
 
-                    shutil.copyfileobj(f_in, f_out)
+                    # The data must pass through zipfile's CRC computation and
+                    # the signing wrapper, so it can't be copied in the kernel.
+                    # Use larger chunks to reduce per-call overhead instead.
+                    shutil.copyfileobj(f_in, f_out, 1024 * 1024)
 
         print_status('Generating', PATH_METADATA, 'and', PATH_METADATA_PB)
         metadata = ota.add_metadata(
             z_out,
             metadata_info,
             metadata_pb_info,
-            metadata_pb_raw,
+            orig_metadata,
         )
 
         # Signing process needs to capture the zip central directory
@@ -413,74 +605,90 @@ def patch_subcommand(args):
     if output is None:
         output = args.input + '.patched'
 
-    if args.rootless:
-        root_patch = None
-    elif args.magisk is not None:
-        root_patch = boot.MagiskRootPatch(
-            args.magisk, args.magisk_preinit_device, args.magisk_random_seed)
-
-        try:
-            root_patch.validate()
-        except ValueError as e:
-            if args.ignore_magisk_warnings:
-                print_warning(e)
-            else:
-                raise e
-    else:
-        root_patch = boot.PrepatchedImage(
-            args.prepatched,
-            args.ignore_prepatched_compat + 1,
-            print_warning,
-        )
+    # The root patch may keep files open until patching is complete
+    with contextlib.ExitStack() as stack:
+        if args.rootless:
+            root_patch = None
+        elif args.magisk is not None:
+            root_patch = stack.enter_context(boot.MagiskRootPatch(
+                args.magisk,
+                args.magisk_preinit_device,
+                args.magisk_random_seed,
+            ))
+
+            try:
+                root_patch.validate()
+            except ValueError as e:
+                if args.ignore_magisk_warnings:
+                    print_warning(e)
+                else:
+                    raise e
+        else:
+            root_patch = boot.PrepatchedImage(
+                args.prepatched,
+                args.ignore_prepatched_compat + 1,
+                print_warning,
+            )
 
-    # Get passphrases for keys
-    passphrase_avb = openssl.prompt_passphrase(
-        args.privkey_avb,
-        args.passphrase_avb_env_var,
-        args.passphrase_avb_file,
-    )
-    passphrase_ota = openssl.prompt_passphrase(
-        args.privkey_ota,
-        args.passphrase_ota_env_var,
-        args.passphrase_ota_file,
-    )
+        # Get passphrases for keys
+        passphrase_avb = openssl.prompt_passphrase(
+            args.privkey_avb,
+            args.passphrase_avb_env_var,
+            args.passphrase_avb_file,
+        )
+        passphrase_ota = openssl.prompt_passphrase(
+            args.privkey_ota,
+            args.passphrase_ota_env_var,
+            args.passphrase_ota_file,
+        )
 
-    # Ensure that the certificate matches the private key
-    if not openssl.cert_matches_key(args.cert_ota, args.privkey_ota,
-                                    passphrase_ota):
-        raise Exception('OTA certificate does not match private key')
+        # Ensure that the certificate matches the private key
+        if not openssl.cert_matches_key(args.cert_ota, args.privkey_ota,
+                                        passphrase_ota):
+            raise Exception('OTA certificate does not match private key')
 
-    start = time.perf_counter_ns()
+        start = time.perf_counter_ns()
 
-    with util.open_output_file(output) as temp_raw:
-        with (
-            ota.open_signing_wrapper(temp_raw, args.privkey_ota,
-                                     passphrase_ota, args.cert_ota) as temp,
-            ota.match_android_zip64_limit(),
-            fix_streaming_local_header_sizes(),
-        ):
-            context = PatchContext(
-                replace_images=args.replace or {},
-                boot_partition=args.boot_partition,
-                root_patch=root_patch,
-                clear_vbmeta_flags=args.clear_vbmeta_flags,
-                privkey_avb=args.privkey_avb,
-                passphrase_avb=passphrase_avb,
-                privkey_ota=args.privkey_ota,
-                passphrase_ota=passphrase_ota,
-                cert_ota=args.cert_ota,
-            )
+        with util.open_output_file(output) as temp_raw:
+            with (
+                ota.open_signing_wrapper(
+                    temp_raw,
+                    args.privkey_ota,
+                    passphrase_ota,
+                    args.cert_ota,
+                ) as temp,
+                ota.match_android_zip64_limit(),
+                fix_streaming_local_header_sizes(),
+                # Extraction, patching, and building all run on the same
+                # thread pool. Most of the work is CPU bound and releases the
+                # GIL, so it's sized to the number of CPUs instead of the
+                # number of images.
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=os.cpu_count()) as executor,
+            ):
+                context = PatchContext(
+                    replace_images=args.replace or {},
+                    boot_partition=args.boot_partition,
+                    root_patch=root_patch,
+                    clear_vbmeta_flags=args.clear_vbmeta_flags,
+                    privkey_avb=args.privkey_avb,
+                    passphrase_avb=passphrase_avb,
+                    privkey_ota=args.privkey_ota,
+                    passphrase_ota=passphrase_ota,
+                    cert_ota=args.cert_ota,
+                    executor=executor,
+                )
 
-            metadata = patch_ota_zip(args.input, temp, context)
+                metadata = patch_ota_zip(args.input, temp, context)
 
-        # We do a lot of low-level hackery. Reopen and verify offsets
-        print_status('Verifying metadata offsets')
-        with zipfile.ZipFile(temp_raw, 'r') as z:
-            ota.verify_metadata(z, metadata)
+            # We do a lot of low-level hackery. Reopen and verify offsets
+            print_status('Verifying metadata offsets')
+            with zipfile.ZipFile(temp_raw, 'r') as z:
+                ota.verify_metadata(z, metadata)
 
-    # Excluding the time it takes for the user to type in the passwords
-    elapsed = time.perf_counter_ns() - start
-    print_status(f'Completed after {elapsed / 1_000_000_000:.1f}s')
+        # Excluding the time it takes for the user to type in the passwords
+        elapsed = time.perf_counter_ns() - start
+        print_status(f'Completed after {elapsed / 1_000_000_000:.1f}s')
 
 
 def extract_subcommand(args):
@@ -490,11 +698,13 @@ def extract_subcommand(args):
         with z.open(info, 'r') as f:
             _, manifest, blob_offset = ota.parse_payload(f)
 
+        all_partitions = get_all_partitions(manifest)
+
         if args.all:
-            unique_images = set(p.partition_name
-                                for p in manifest.partitions)
+            unique_images = all_partitions
         else:
-            images = get_required_images(manifest, args.boot_partition, True)
+            images = get_required_images(manifest, args.boot_partition, True,
+                                         all_partitions)
             if args.boot_only:
                 unique_images = {images['@rootpatch']}
             else:
@@ -719,6 +929,7 @@ def parse_args(argv=None):
 def main(argv=None):
     args = parse_args(argv=argv)
 
+    _setup_logging()
     util.load_umask_unsafe()
 
     if args.subcommand == 'patch':
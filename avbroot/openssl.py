@@ -1,24 +1,34 @@
 import binascii
 import contextlib
+import functools
 import getpass
 import os
 import random
 import string
 import subprocess
+import threading
 import unittest.mock
 
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, utils
+except ImportError:
+    x509 = None
+
 # This module calls the openssl binary because AOSP's avbtool.py already does
 # that and the operations are simple enough to not require pulling in a
-# library.
+# library. If the cryptography library is installed, then it is used instead
+# for the operations that avbroot performs itself to avoid spawning a process
+# for each one. The passphrase injection is still needed for avbtool.
 
 
 @contextlib.contextmanager
 def _passphrase_fd(passphrase):
     '''
     If the specified passphrase is not None, yield the readable end of a pipe
-    that produces the passphrase encoded as UTF-8, followed by a newline. The
-    read end of the pipe is marked as inheritable. Both ends of the pipe are
-    closed after leaving the context.
+    that produces the passphrase encoded as UTF-8, followed by a newline. Both
+    ends of the pipe are closed after leaving the context.
     '''
 
     assert os.name != 'nt'
@@ -37,8 +47,6 @@ def _passphrase_fd(passphrase):
     write_closed = False
 
     try:
-        os.set_inheritable(pipe_r, True)
-
         os.write(pipe_w, passphrase.encode('UTF-8'))
         os.write(pipe_w, b'\n')
         os.close(pipe_w)
@@ -51,12 +59,48 @@ def _passphrase_fd(passphrase):
             os.close(pipe_w)
 
 
+_passphrase_memfds = {}
+_passphrase_memfds_lock = threading.Lock()
+
+
+def _passphrase_memfd(passphrase):
+    '''
+    Get a memfd containing the passphrase encoded as UTF-8, followed by a
+    newline. The memfd is created the first time a passphrase is used and is
+    kept open for the lifetime of the process so that it can be reused by every
+    openssl invocation. Returns None if memfds are not supported.
+
+    Child processes should open the memfd via /proc/self/fd/<fd> instead of
+    reading from the passed fd directly. This gives each child its own file
+    offset so that multiple openssl processes can run in parallel.
+    '''
+
+    if not hasattr(os, 'memfd_create') or not os.path.isdir('/proc/self/fd'):
+        return None
+
+    with _passphrase_memfds_lock:
+        fd = _passphrase_memfds.get(passphrase)
+        if fd is None:
+            fd = os.memfd_create('passphrase', os.MFD_CLOEXEC)
+
+            try:
+                os.write(fd, passphrase.encode('UTF-8'))
+                os.write(fd, b'\n')
+            except BaseException:
+                os.close(fd)
+                raise
+
+            _passphrase_memfds[passphrase] = fd
+
+        return fd
+
+
 class _PopenPassphraseWrapper:
     '''
     Wrapper around subprocess.Popen() that adds arguments for passing in the
-    private key passphrase via a pipe on non-Windows systems. On Windows,
-    openssl does not support reading from pipes, so the passphrase is passed in
-    via an environment variable.
+    private key passphrase via a memfd (Linux) or pipe on non-Windows systems.
+    On Windows, openssl does not support reading from pipes, so the passphrase
+    is passed in via an environment variable.
     '''
 
     def __init__(self, passphrase):
@@ -78,10 +122,16 @@ class _PopenPassphraseWrapper:
 
                 new_cmd = [*cmd, '-passin', f'env:{env_var}']
 
+                return self.orig_popen(new_cmd, *args, **kwargs)
+            elif (fd := _passphrase_memfd(self.passphrase)) is not None:
+                kwargs['pass_fds'] = (*kwargs.get('pass_fds', ()), fd)
+
+                new_cmd = [*cmd, '-passin', f'file:/proc/self/fd/{fd}']
+
                 return self.orig_popen(new_cmd, *args, **kwargs)
             else:
                 with _passphrase_fd(self.passphrase) as fd:
-                    kwargs['close_fds'] = False
+                    kwargs['pass_fds'] = (*kwargs.get('pass_fds', ()), fd)
 
                     new_cmd = [*cmd, '-passin', f'fd:{fd}']
 
@@ -98,14 +148,23 @@ def inject_passphrase(passphrase):
     '''
     While this context is active, patch subprocess calls to openssl so that
     the passphrase is specified via an injected -passin argument, if it is not
-    None. The passphrase is passed to the command via a pipe file descriptor
-    (non-Windows) or an environment variable (Windows).
+    None. The passphrase is passed to the command via a memfd or pipe file
+    descriptor (non-Windows) or an environment variable (Windows).
     '''
 
     return unittest.mock.patch(
         'subprocess.Popen', side_effect=_PopenPassphraseWrapper(passphrase))
 
 
+def _is_pem(data):
+    '''
+    Simple heuristic to determine if <data> is PEM encoded.
+    '''
+
+    return any(line.startswith(b'-----BEGIN ') for line in data.splitlines())
+
+
+@functools.lru_cache(maxsize=None)
 def _guess_format(path):
     '''
     Simple heuristic to determine the encoding of a key. This is needed because
@@ -113,11 +172,38 @@ def _guess_format(path):
     '''
 
     with open(path, 'rb') as f:
-        for line in f:
-            if line.startswith(b'-----BEGIN '):
-                return 'PEM'
+        return 'PEM' if _is_pem(f.read()) else 'DER'
+
 
-    return 'DER'
+def _load_private_key(path, passphrase):
+    '''
+    Load a private key with the cryptography library.
+    '''
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if passphrase is not None:
+        passphrase = passphrase.encode('UTF-8')
+
+    if _is_pem(data):
+        return serialization.load_pem_private_key(data, passphrase)
+    else:
+        return serialization.load_der_private_key(data, passphrase)
+
+
+def _load_certificate(path):
+    '''
+    Load an x509 certificate with the cryptography library.
+    '''
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if _is_pem(data):
+        return x509.load_pem_x509_certificate(data)
+    else:
+        return x509.load_der_x509_certificate(data)
 
 
 def _get_modulus(path, passphrase, is_x509):
@@ -149,14 +235,25 @@ def max_signature_size(pkey, passphrase):
     is equal to the modulus size.
     '''
 
+    if x509 is not None:
+        key = _load_private_key(pkey, passphrase)
+
+        return (key.key_size + 7) // 8
+
     return len(_get_modulus(pkey, passphrase, False))
 
 
 def sign_data(pkey, passphrase, data):
     '''
-    Sign <data> with <pkey>.
+    Sign <data> with <pkey>. <data> must be a SHA256 digest.
     '''
 
+    if x509 is not None:
+        key = _load_private_key(pkey, passphrase)
+
+        return key.sign(data, padding.PKCS1v15(),
+                        utils.Prehashed(hashes.SHA256()))
+
     with inject_passphrase(passphrase):
         return subprocess.check_output(
             [
@@ -175,10 +272,23 @@ def cert_matches_key(cert, pkey, passphrase):
     Check that the x509 certificate matches the RSA private key.
     '''
 
+    if x509 is not None:
+        # Comparing the whole public key also checks the public exponent
+        encoding = serialization.Encoding.DER
+        format = serialization.PublicFormat.SubjectPublicKeyInfo
+
+        cert_spki = _load_certificate(cert).public_key() \
+            .public_bytes(encoding, format)
+        pkey_spki = _load_private_key(pkey, passphrase).public_key() \
+            .public_bytes(encoding, format)
+
+        return cert_spki == pkey_spki
+
     return _get_modulus(cert, None, True) \
         == _get_modulus(pkey, passphrase, False)
 
 
+@functools.lru_cache(maxsize=None)
 def _is_encrypted(pkey):
     '''
     Check if a private key is encrypted.
@@ -216,7 +326,11 @@ def prompt_passphrase(pkey, passphrase_env_var=None, passphrase_file=None):
         passphrase = getpass.getpass(f'Passphrase for {pkey}: ')
 
     # Verify that it is correct
-    with inject_passphrase(passphrase):
-        subprocess.check_output(['openssl', 'pkey', '-in', pkey, '-noout'])
+    if x509 is not None:
+        _load_private_key(pkey, passphrase)
+    else:
+        with inject_passphrase(passphrase):
+            subprocess.check_output(
+                ['openssl', 'pkey', '-in', pkey, '-noout'])
 
     return passphrase
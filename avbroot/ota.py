@@ -105,12 +105,14 @@ def _extract_image(f_payload, f_out, block_size, blob_offset, partition,
                                  binascii.hexlify(op.data_sha256_hash)))
 
 
-def extract_images(f, manifest, blob_offset, output_dir, partition_names):
+def extract_images(f, manifest, blob_offset, output_dir, partition_names,
+                   executor=None):
     '''
     Extract the specified partition images from the payload into <output_dir>.
 
     If <f> is callable, then it should produce a new file object each time it
-    is called. This allows extracting images in parallel.
+    is called. This allows extracting images in parallel. The extraction tasks
+    are run on <executor> if specified. Otherwise, a new thread pool is used.
     '''
 
     remaining = set(partition_names)
@@ -127,6 +129,8 @@ def extract_images(f, manifest, blob_offset, output_dir, partition_names):
 
         f = dummy
         max_workers = 1
+        # The file object can't be shared between threads
+        executor = None
 
     def extract(p):
         output_path = os.path.join(output_dir, p.partition_name + '.img')
@@ -138,8 +142,11 @@ def extract_images(f, manifest, blob_offset, output_dir, partition_names):
             _extract_image(f_in, f_out, manifest.block_size, blob_offset, p,
                            cancel_signal)
 
-    with concurrent.futures.ThreadPoolExecutor(
-            max_workers=max_workers) as executor:
+    with contextlib.ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(max_workers=max_workers))
+
         try:
             for p in manifest.partitions:
                 if p.partition_name not in remaining:
@@ -153,6 +160,9 @@ def extract_images(f, manifest, blob_offset, output_dir, partition_names):
                 future.result()
         except BaseException:
             cancel_signal.set()
+            # A shared executor is not shut down when leaving this function,
+            # so make sure nothing is still writing to the output files
+            concurrent.futures.wait(futures)
             raise
 
     if remaining:
@@ -541,6 +551,8 @@ class _FakeZipFile:
         # guarantee that ZipFile writes sequentially.
         self.orig_fp = self.zip.fp
         if isinstance(self.orig_fp, _TeeFileDescriptor):
+            # Make sure buffered writes have reached the backing file
+            self.orig_fp.flush()
             self.orig_fp = self.orig_fp.backing
 
         self.fp.add_file(self.orig_fp)
@@ -578,20 +590,29 @@ class _FakeZipFile:
                 self.next_offset += len(buf_without_footer)
 
 
-def add_metadata(z_out, metadata_info, metadata_pb_info, metadata_pb_raw):
+def parse_metadata(data):
+    '''
+    Parse the serialized OTA metadata protobuf struct.
+    '''
+
+    metadata = ota_metadata_pb2.OtaMetadata()
+    metadata.ParseFromString(data)
+
+    return metadata
+
+
+def add_metadata(z_out, metadata_info, metadata_pb_info, metadata):
     '''
     Add metadata files to the output OTA zip. <metadata_info> and
     <metadata_pb_info> should be the ZipInfo instances associated with the
-    files from the original OTA zip. <metadata_pb_raw> should be the serialized
-    OTA metadata protobuf struct from the original OTA.
+    files from the original OTA zip. <metadata> should be the OTA metadata
+    protobuf struct from the original OTA. It is modified in place and
+    returned.
 
     The zip file's backing file position MUST BE set to where the central
     directory would start.
     '''
 
-    metadata = ota_metadata_pb2.OtaMetadata()
-    metadata.ParseFromString(metadata_pb_raw)
-
     metadata.property_files.clear()
 
     props = _get_property_files()
@@ -643,29 +664,50 @@ class _TeeFileDescriptor:
     '''
     A file-like instance that propagates writes to multiple streams.
 
+    Small writes are buffered up to <buffer_size> bytes to reduce the overhead
+    of writing to every stream. flush() writes out the buffered data.
+
     start_capture() is used to pause output and divert writes to a memory
     buffer until _finish_capture(), which can modify the buffer.
     '''
 
-    def __init__(self, streams, file_index=None):
+    def __init__(self, streams, file_index=None, buffer_size=1024 * 1024):
         self.streams = streams
         self.capture = None
         self.backing = None if file_index is None else streams[file_index]
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+
+    def _write_streams(self, data):
+        for stream in self.streams:
+            # Naive hole punching to create sparse files
+            if stream is self.backing and util.is_zero(data):
+                stream.seek(len(data), os.SEEK_CUR)
+            else:
+                stream.write(data)
+
+    def _flush_buffer(self):
+        if self.buffer:
+            self._write_streams(self.buffer)
+            self.buffer.clear()
 
     def write(self, data):
         if self.capture:
             self.capture.write(data)
         else:
-            for stream in self.streams:
-                # Naive hole punching to create sparse files
-                if stream is self.backing and util.is_zero(data):
-                    stream.seek(len(data), os.SEEK_CUR)
-                else:
-                    stream.write(data)
+            if len(self.buffer) + len(data) > self.buffer_size:
+                self._flush_buffer()
+
+            if len(data) >= self.buffer_size:
+                self._write_streams(data)
+            else:
+                self.buffer.extend(data)
 
         return len(data)
 
     def flush(self):
+        self._flush_buffer()
+
         for stream in self.streams:
             stream.flush()
 
@@ -675,12 +717,15 @@ class _TeeFileDescriptor:
             raise AttributeError('tell is not supported')
 
         capture_len = self.capture.tell() if self.capture else 0
-        return self.backing.tell() + capture_len
+        return self.backing.tell() + len(self.buffer) + capture_len
 
     def start_capture(self):
         if self.capture is not None:
             raise RuntimeError('Capture already started')
 
+        # Everything written before the capture must reach the streams first
+        self._flush_buffer()
+
         self.capture = _MemoryFile()
 
     @contextlib.contextmanager
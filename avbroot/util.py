@@ -1,6 +1,7 @@
 import contextlib
 import dataclasses
 import functools
+import io
 import os
 import tempfile
 
@@ -142,6 +143,52 @@ def copyfileobj_n(f_in, f_out, size, buf_size=16384, hasher=None):
         raise IOError(f'Unexpected EOF; expected {size} more bytes')
 
 
+def copy_file_range_n(f_in, f_out, size, buf_size=16384):
+    '''
+    Copy <size> bytes from <f_in> to <f_out>. If both are backed by OS-level
+    files, the data is copied in the kernel via os.copy_file_range(), which
+    also allows filesystems with reflink support to share the underlying
+    blocks. Otherwise, this falls back to copyfileobj_n().
+
+    Raises IOError if EOF is reached in <f_in> before <size> bytes are read.
+    '''
+
+    copied = 0
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            fd_in = f_in.fileno()
+            fd_out = f_out.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            fd_in = fd_out = None
+
+        if fd_in is not None:
+            # Explicit offsets are used so that the buffered file objects'
+            # positions can be kept in sync
+            f_out.flush()
+            offset_in = f_in.tell()
+            offset_out = f_out.tell()
+
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fd_in, fd_out, size - copied,
+                                           offset_in + copied,
+                                           offset_out + copied)
+                    if not n:
+                        break
+
+                    copied += n
+            except OSError:
+                # Not supported for this pair of files. Copy the remainder
+                # in userspace.
+                pass
+
+            f_in.seek(offset_in + copied)
+            f_out.seek(offset_out + copied)
+
+    copyfileobj_n(f_in, f_out, size - copied, buf_size=buf_size)
+
+
 def decompress_n(decompressor, f_in, f_out, size, buf_size=16384, hasher=None):
     '''
     Read <size> bytes from <f_in> and decompress them to <f_out>.
@@ -5,7 +5,6 @@ import unittest.mock
 
 import avbtool
 
-from . import openssl
 from . import util
 
 
@@ -27,6 +26,10 @@ def smuggle_descriptors():
     * create a AvbKernelCmdlineDescriptor instance for each item
     * assign kernel_cmdline to each descriptor instance
     * call encode on each descriptor
+
+    This patches global state and unittest.mock.patch() is not thread safe.
+    When building images in parallel, this context must be entered once around
+    all of the threads instead of within each one.
     '''
 
     with unittest.mock.patch('avbtool.AvbKernelCmdlineDescriptor',
@@ -118,12 +121,14 @@ def patch_vbmeta_image(
     input_path: os.PathLike[str],
     output_path: os.PathLike[str],
     key: os.PathLike[str],
-    passphrase: str,
     padding_size: int,
     clear_flags: bool,
 ):
     '''
     Patch the vbmeta image to reference the provided images.
+
+    This must be called within smuggle_descriptors() and
+    openssl.inject_passphrase() for the passphrase of <key>.
     '''
 
     # Load the original root vbmeta image
@@ -168,28 +173,24 @@ def patch_vbmeta_image(
 
     with util.open_output_file(output_path) as f:
         # Smuggle in the prebuilt descriptors via kernel_cmdlines
-        with (
-            smuggle_descriptors(),
-            openssl.inject_passphrase(passphrase),
-        ):
-            avb.make_vbmeta_image(
-                output=f,
-                chain_partitions=None,
-                algorithm_name=algorithm_name,
-                key_path=key,
-                public_key_metadata_path=None,
-                rollback_index=header.rollback_index,
-                flags=header.flags,
-                rollback_index_location=header.rollback_index_location,
-                props=None,
-                props_from_file=None,
-                kernel_cmdlines=new_descriptors,
-                setup_rootfs_from_kernel=None,
-                include_descriptors_from_image=None,
-                signing_helper=None,
-                signing_helper_with_files=None,
-                release_string=header.release_string,
-                append_to_release_string=False,
-                print_required_libavb_version=False,
-                padding_size=padding_size,
-            )
+        avb.make_vbmeta_image(
+            output=f,
+            chain_partitions=None,
+            algorithm_name=algorithm_name,
+            key_path=key,
+            public_key_metadata_path=None,
+            rollback_index=header.rollback_index,
+            flags=header.flags,
+            rollback_index_location=header.rollback_index_location,
+            props=None,
+            props_from_file=None,
+            kernel_cmdlines=new_descriptors,
+            setup_rootfs_from_kernel=None,
+            include_descriptors_from_image=None,
+            signing_helper=None,
+            signing_helper_with_files=None,
+            release_string=header.release_string,
+            append_to_release_string=False,
+            print_required_libavb_version=False,
+            padding_size=padding_size,
+        )